@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from flask import Flask
+from PIL import Image
+from wtforms.fields.simple import SubmitField
+
+from src.fields import fields
+from src.database import FormDB, connect
+from src.forms import build_form
+from src.utils import DFSClient, generate_fields, img_to_bytes, read_image
+
+
+def measure(fn, repeat, number=1):
+    fn()
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for _ in range(number):
+            fn()
+
+        times.append((time.perf_counter() - start) / number)
+
+    return {
+        'runs': repeat * number,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times)
+    }
+
+
+def make_form_db(path, form_count, field_count=10, select_count=3, choice_count=20):
+    db = FormDB(connect(path))
+    db.initialize()
+
+    for i in range(select_count):
+        db.save_select_field(f'select{i}', [f'choice{j}' for j in range(choice_count)])
+
+    for i in range(form_count):
+        db.save_form(f'form{i}', {
+            'doc_form': f'template{i % 10}'.encode(),
+            'static_fields': {
+                f'field{j}': {'type': j % 3, 'label': f'Field {j}'} for j in range(field_count)
+            },
+            'select_fields': {
+                f'sel{j}': {'label': f'select{j}'} for j in range(select_count)
+            }
+        })
+
+    return db
+
+
+def bench_get_form_by_id(directory, sizes, repeat):
+    results = []
+
+    for size in sizes:
+        db = make_form_db(os.path.join(directory, f'forms-{size}.db'), size)
+        form_id = size // 2 + 1
+
+        results.append({
+            'name': 'FormDB.get_form_by_id',
+            'params': {'forms': size},
+            **measure(lambda: db.get_form_by_id(form_id), repeat, 20)
+        })
+
+        db.connection.close()
+
+    return results
+
+
+def bench_create_form(sizes, repeat):
+    results = []
+
+    app = Flask(__name__)
+    app.secret_key = 'benchmark'
+
+    for size in sizes:
+        definition = {
+            'static_fields': {
+                f'field{i}': {'type': i % 4, 'label': f'Field {i}'} for i in range(size)
+            },
+            'select_fields': {}
+        }
+
+        def create():
+            form_fields = generate_fields(definition, fields)
+            form_fields['submit'] = SubmitField('Отправить')
+            build_form(form_fields)(meta={'csrf': False})
+
+        with app.test_request_context():
+            results.append({
+                'name': 'generate_fields+create_form',
+                'params': {'fields': size},
+                **measure(create, repeat)
+            })
+
+    return results
+
+
+def bench_images(repeat):
+    results = []
+
+    for img_format, size in (('PNG', (1600, 1200)), ('JPEG', (4000, 3000))):
+        b = BytesIO()
+        Image.effect_noise(size, 64).convert('RGB').save(b, format=img_format)
+        raw = b.getvalue()
+
+        def reencode():
+            img_to_bytes(Image.open(BytesIO(raw)))
+
+        results.append({
+            'name': 'img_to_bytes',
+            'params': {'format': img_format, 'width': size[0], 'height': size[1], 'bytes': len(raw)},
+            **measure(reencode, repeat)
+        })
+        results.append({
+            'name': 'read_image',
+            'params': {'format': img_format, 'width': size[0], 'height': size[1], 'bytes': len(raw)},
+            **measure(lambda: read_image(BytesIO(raw)), repeat, 20)
+        })
+
+    return results
+
+
+class StubDFS(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._reply(b'ok')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self._reply(b'\0' * 65536)
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def bench_send_template(repeat):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubDFS)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    client = DFSClient(f'http://127.0.0.1:{server.server_port}')
+    results = []
+
+    try:
+        for size in (16384, 1048576):
+            doc_form = b'\0' * size
+
+            def send():
+                client.send_template(doc_form, {'field': 'value'}, {}).content
+
+            results.append({
+                'name': 'DFSClient.send_template',
+                'params': {'template_bytes': size},
+                **measure(send, repeat, 5)
+            })
+    finally:
+        client.close()
+        server.shutdown()
+
+    return results
+
+
+STARTUP = """
+import sys, time
+start = time.perf_counter()
+from src import create_app
+create_app({
+    'DFS': {'url': 'http://127.0.0.1:1', 'health_interval': '3600'},
+    'Editor_access': {'enabled': '1', 'allow_requests': '0'},
+    'Database': {'forms': sys.argv[1], 'editors': sys.argv[2]}
+})
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(directory, repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    args = [sys.executable, '-c', STARTUP, os.path.join(directory, 'startup-forms.db'), os.path.join(directory, 'startup-editors.db')]
+
+    times = [float(subprocess.run(args, cwd=root, capture_output=True, check=True, text=True).stdout) for _ in range(repeat)]
+
+    return [{
+        'name': 'import+create_app',
+        'params': {},
+        'runs': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times)
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Измерение времени этапов обработки формы')
+    parser.add_argument('-o', '--output', help='файл для результатов в формате JSON (по умолчанию stdout)')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='количество повторов каждого замера')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='размеры синтетических данных')
+    args = parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        results.extend(bench_get_form_by_id(directory, args.sizes, args.repeat))
+        results.extend(bench_startup(directory, args.repeat))
+
+    results.extend(bench_create_form(args.sizes, args.repeat))
+    results.extend(bench_images(args.repeat))
+    results.extend(bench_send_template(args.repeat))
+
+    report = {
+        'timestamp': time.time(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
-from src.database import EditorDB
-from src import editor_db
+import argparse
+import csv
+import json
+import sys
+
+from src import load_config
+from src.database import EditorDB, connect
 
 
 def search_data(db):
@@ -64,9 +69,79 @@ def get_max_length(rows):
     return length
 
 
-def main():
-    db = EditorDB(editor_db)
+def read_names(args):
+    names = list(args.names)
+
+    if args.file:
+        f = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+
+        with f:
+            names.extend(line.strip() for line in f if line.strip())
+
+    return names
+
+
+def write_rows(rows, fields, output_format):
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        json.dump(rows, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+def run_command(db, args):
+    if args.command == 'list':
+        if args.status == 'approved':
+            rows = db.get_by_approval(True)
+        elif args.status == 'pending':
+            rows = db.get_by_approval(False)
+        else:
+            rows = db.get_by_approval(False) + db.get_by_approval(True)
+
+        write_rows([{'name': name, 'approved': bool(approved)} for name, approved in rows], ['name', 'approved'], args.format)
+        return 0
+
+    if args.command == 'purge':
+        write_rows([{'deleted': db.delete_all_nonapproved()}], ['deleted'], args.format)
+        return 0
+
+    names = read_names(args)
+
+    if args.command == 'approve':
+        found, status = set(db.approve_many(names)), 'approved'
+    else:
+        found, status = set(db.delete_many(names)), 'deleted'
+
+    rows = [{'name': name, 'status': status if name in found else 'not_found'} for name in dict.fromkeys(names)]
+    write_rows(rows, ['name', 'status'], args.format)
+
+    return 0 if len(found) == len(rows) else 1
 
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Управление редакторами; без команды запускается интерактивное меню')
+    commands = parser.add_subparsers(dest='command')
+
+    formats = argparse.ArgumentParser(add_help=False)
+    formats.add_argument('--format', choices=['json', 'csv'], default='json', help='формат вывода (по умолчанию json)')
+
+    names = argparse.ArgumentParser(add_help=False)
+    names.add_argument('names', nargs='*', help='имена редакторов')
+    names.add_argument('-f', '--file', help='файл с именами, по одному в строке ("-" - стандартный ввод)')
+
+    list_parser = commands.add_parser('list', parents=[formats], help='вывести список редакторов')
+    list_parser.add_argument('--status', choices=['all', 'approved', 'pending'], default='all', help='какие запросы выводить')
+
+    commands.add_parser('approve', parents=[formats, names], help='одобрить запросы')
+    commands.add_parser('delete', parents=[formats, names], help='удалить редакторов')
+    commands.add_parser('purge', parents=[formats], help='удалить все неодобренные запросы')
+
+    return parser.parse_args()
+
+
+def menu(db):
     while True:
         cmd = input(
 '''Выберите действие:
@@ -122,5 +197,18 @@ def main():
             print('-' * 20)
 
 
+def main():
+    args = parse_args()
+    config = load_config('config.ini')
+
+    db = EditorDB(connect(config.get('Database', 'editors', fallback='editors.db')))
+    db.initialize()
+
+    if args.command:
+        sys.exit(run_command(db, args))
+
+    menu(db)
+
+
 if __name__ == '__main__':
     main()
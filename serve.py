@@ -0,0 +1,43 @@
+from gunicorn.app.base import BaseApplication
+
+from src import create_app, load_config
+
+
+class Server(BaseApplication):
+    def __init__(self, options, config_path='config.ini'):
+        self.options = options
+        self.config_path = config_path
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return create_app(self.config_path)
+
+
+def post_fork(server, worker):
+    server.app.wsgi().extensions['former.reset']()
+
+
+def main():
+    config = load_config('config.ini')
+
+    options = {
+        'bind': config.get('Server', 'bind', fallback='127.0.0.1:8000'),
+        'workers': config.getint('Server', 'workers', fallback=4),
+        'threads': config.getint('Server', 'threads', fallback=4),
+        'timeout': config.getint('Server', 'timeout', fallback=120),
+        'graceful_timeout': config.getint('Server', 'graceful_timeout', fallback=30),
+        'max_requests': config.getint('Server', 'max_requests', fallback=1000),
+        'max_requests_jitter': config.getint('Server', 'max_requests_jitter', fallback=100),
+        'preload_app': True,
+        'post_fork': post_fork
+    }
+
+    Server(options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,104 +1,202 @@
+import atexit
 import configparser
+import logging
 import os
+import time
 
-from flask import Flask, g, render_template
-
-from flask_wtf import CSRFProtect
-from flask_wtf.file import FileField, FileRequired, FileAllowed
-from wtforms.fields.choices import SelectField
-from wtforms.fields.simple import StringField, BooleanField, TextAreaField
-from wtforms.validators import InputRequired
-
-from .routes import index_page, form_page, form_editor_page, field_editor_page, auth_page
-from .database import FormDB, EditorDB
-from .utils import Fields
-
-from dotenv import load_dotenv
-
-load_dotenv('.flaskenv')
-load_dotenv()
-
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-dfs_url = config['DFS']['url']
-editor_access = config.getboolean('Editor_access', 'enabled')
-editor_requests = config.getboolean('Editor_access', 'allow_requests')
-
-db_name = 'forms.db'
-FormDB(db_name).initialize()
-
-editor_db = 'editors.db'
-EditorDB(editor_db).initialize()
-
-app = Flask(__name__)
-
-app.secret_key = os.environ.get('SECRET_KEY')
-
-app.register_blueprint(index_page)
-app.register_blueprint(form_page)
-app.register_blueprint(form_editor_page)
-app.register_blueprint(field_editor_page)
-app.register_blueprint(auth_page)
-
-csrf = CSRFProtect(app)
-
-fields = Fields(
-    default_data={
-        'class': SelectField,
-        'kwargs': {
-            'validators': [InputRequired()]
-        }
-    },
-    Bool={
-        'class': BooleanField,
-    },
-    Text={
-        'class': StringField,
-        'kwargs': {
-            'validators': [InputRequired()]
-        }
-    },
-    TextArea={
-        'class': TextAreaField,
-        'kwargs': {
-            'validators': [InputRequired()],
-        },
-        'type': 'html'
-    },
-    File={
-        'class': FileField,
-        'kwargs': {
-            'validators': [FileRequired(), FileAllowed(['png', 'jpg'])]
-        },
-        'type': 'image'
-    }
-)
-
-predefined_fields = [
-    (fields.type.Bool, 'Флажок'),
-    (fields.type.Text, 'Текстовое поле'),
-    (fields.type.TextArea, 'Поле для HTML'),
-    (fields.type.File, 'Картинка')
-]
-
-
-@app.before_request
-def load_globals():
-    g.db = FormDB(db_name)
-    g.editors = EditorDB(editor_db)
-    g.dfs_url = dfs_url
-    g.fields = fields
-    g.predefined_fields = predefined_fields
-    g.editor_access = editor_access
-    g.editor_requests = editor_requests
-
-
-@app.errorhandler(404)
-def not_found(e):
-    return render_template('404.html'), 404
-
-
-@app.errorhandler(503)
-def service_not_available(e):
-    return render_template('503.html'), 503
+
+logger = logging.getLogger(__name__)
+
+
+def load_config(config='config.ini'):
+    if isinstance(config, configparser.ConfigParser):
+        return config
+
+    parser = configparser.ConfigParser()
+
+    if isinstance(config, dict):
+        parser.read_dict(config)
+    else:
+        parser.read(config)
+
+    return parser
+
+
+def create_app(config='config.ini'):
+    start = time.perf_counter()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    from dotenv import load_dotenv
+    from flask import Flask, g, render_template
+    from flask_wtf import CSRFProtect
+
+    from .routes import index_page, form_page, job_page, metrics_page, form_editor_page, field_editor_page, auth_page
+    from .database import FormDB, EditorDB, ConnectionPool
+    from .migrations import FORM_MIGRATIONS, EDITOR_MIGRATIONS
+    from .forms import FormCache
+    from .cache import ApprovalCache, VersionedCache
+    from .metrics import Metrics, Callback
+    from .fields import fields, predefined_fields
+    from .utils import DFSClient, HealthProber
+
+    load_dotenv('.flaskenv')
+    load_dotenv()
+
+    config = load_config(config)
+
+    metrics = Metrics()
+
+    if config.get('Renderer', 'engine', fallback='dfs') == 'local':
+        from .renderer import LocalRenderer
+
+        renderer = LocalRenderer(
+            workers=config.getint('Renderer', 'workers', fallback=4),
+            timeout=config.getfloat('DFS', 'read_timeout', fallback=60.0),
+            metrics=metrics
+        )
+    else:
+        renderer = DFSClient(
+            config['DFS']['url'],
+            connect_timeout=config.getfloat('DFS', 'connect_timeout', fallback=3.0),
+            read_timeout=config.getfloat('DFS', 'read_timeout', fallback=60.0),
+            pool_size=config.getint('DFS', 'pool_size', fallback=10),
+            metrics=metrics,
+            by_hash=config.getboolean('DFS', 'send_by_hash', fallback=False)
+        )
+
+
+    chunk_size = config.getint('DFS', 'chunk_size', fallback=65536)
+    spool_threshold = config.getint('DFS', 'spool_threshold', fallback=1048576)
+    dfs_health = HealthProber(renderer, config.getfloat('DFS', 'health_interval', fallback=10.0))
+
+    image_workers = config.getint('Images', 'workers', fallback=4)
+    image_executor = ThreadPoolExecutor(image_workers, thread_name_prefix='former-image')
+    atexit.register(image_executor.shutdown, wait=False)
+
+    approvals = ApprovalCache(config.getfloat('Editor_access', 'approval_ttl', fallback=30.0))
+    draft_ttl = config.getint('Editor_access', 'draft_ttl', fallback=2592000)
+    batch_workers = config.getint('Batch', 'workers', fallback=4)
+
+    documents = None
+    if config.getboolean('Cache', 'enabled', fallback=False):
+        from .cache import DocumentCache
+
+        documents = DocumentCache(
+            config.get('Cache', 'directory', fallback='cache'),
+            max_size=config.getint('Cache', 'max_size', fallback=268435456)
+        )
+        metrics.add(Callback('former_document_cache_hits_total', 'Documents served from the cache', lambda: documents.hits, 'counter'))
+        metrics.add(Callback('former_document_cache_misses_total', 'Documents not found in the cache', lambda: documents.misses, 'counter'))
+        metrics.add(Callback('former_document_cache_bytes', 'Size of the document cache', lambda: documents.size))
+
+    jobs = None
+    if config.getboolean('Jobs', 'enabled', fallback=False):
+        from .jobs import JobQueue
+
+        jobs = JobQueue(
+            config.get('Jobs', 'directory', fallback='jobs'),
+            workers=config.getint('Jobs', 'workers', fallback=4),
+            queue_size=config.getint('Jobs', 'queue_size', fallback=32),
+            ttl=config.getint('Jobs', 'ttl', fallback=600)
+        )
+        atexit.register(jobs.shutdown)
+    editor_access = config.getboolean('Editor_access', 'enabled')
+    editor_requests = config.getboolean('Editor_access', 'allow_requests')
+
+    pool_size = config.getint('Database', 'pool_size', fallback=8)
+    busy_timeout = config.getint('Database', 'busy_timeout', fallback=5000)
+
+    form_pool = ConnectionPool(
+        config.get('Database', 'forms', fallback='forms.db'), pool_size, busy_timeout, FORM_MIGRATIONS
+    )
+    editor_pool = ConnectionPool(
+        config.get('Database', 'editors', fallback='editors.db'), pool_size, busy_timeout, EDITOR_MIGRATIONS
+    )
+
+    atexit.register(form_pool.close)
+    atexit.register(editor_pool.close)
+    atexit.register(dfs_health.stop)
+    atexit.register(renderer.close)
+
+    app = Flask(__name__)
+
+    app.secret_key = os.environ.get('SECRET_KEY')
+
+    app.register_blueprint(index_page)
+    app.register_blueprint(form_page)
+    app.register_blueprint(job_page)
+    if config.getboolean('Metrics', 'enabled', fallback=False):
+        app.register_blueprint(metrics_page)
+    app.register_blueprint(form_editor_page)
+    app.register_blueprint(field_editor_page)
+    app.register_blueprint(auth_page)
+
+    CSRFProtect(app)
+
+    form_cache = FormCache()
+    index_cache = VersionedCache(max_entries=256)
+    choice_cache = VersionedCache()
+    page_size = config.getint('Index', 'page_size', fallback=50)
+
+    def reset_after_fork():
+        nonlocal image_executor
+
+        form_pool.reset()
+        editor_pool.reset()
+        renderer.reset()
+
+        image_executor = ThreadPoolExecutor(image_workers, thread_name_prefix='former-image')
+        atexit.register(image_executor.shutdown, wait=False)
+
+        if jobs:
+            jobs.reset()
+
+    app.extensions['former.reset'] = reset_after_fork
+
+    @app.before_request
+    def load_globals():
+        dfs_health.start()
+
+        g.db = FormDB(form_pool.acquire(), choice_cache)
+        g.editors = EditorDB(editor_pool.acquire(), approvals)
+        g.renderer = renderer
+        g.dfs_health = dfs_health
+        g.chunk_size = chunk_size
+        g.spool_threshold = spool_threshold
+        g.jobs = jobs
+        g.image_executor = image_executor
+        g.documents = documents
+        g.batch_workers = batch_workers
+        g.draft_ttl = draft_ttl
+        g.approvals = approvals
+        g.metrics = metrics
+        g.fields = fields
+        g.form_cache = form_cache
+        g.index_cache = index_cache
+        g.page_size = page_size
+        g.predefined_fields = predefined_fields
+        g.editor_access = editor_access
+        g.editor_requests = editor_requests
+
+    @app.teardown_request
+    def release_connections(e):
+        if 'db' in g:
+            form_pool.release(g.db.connection)
+
+        if 'editors' in g:
+            editor_pool.release(g.editors.connection)
+
+    @app.errorhandler(404)
+    def not_found(e):
+        return render_template('404.html'), 404
+
+    @app.errorhandler(503)
+    def service_not_available(e):
+        return render_template('503.html'), 503
+
+    startup = time.perf_counter() - start
+    metrics.add(Callback('former_startup_seconds', 'Time spent in create_app', lambda: startup))
+    logger.info('Former app created in %.3f s', startup)
+
+    return app
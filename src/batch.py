@@ -0,0 +1,140 @@
+import csv
+import json
+import logging
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from io import StringIO, TextIOWrapper
+
+from werkzeug.datastructures import MultiDict
+
+from .utils import DocumentError, collect_data
+
+
+logger = logging.getLogger(__name__)
+
+
+class ZipStream:
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+
+def read_rows(stream, filename):
+    if not filename.lower().endswith('.jsonl'):
+        yield from csv.DictReader(TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+        return
+
+    for line in TextIOWrapper(stream, encoding='utf-8-sig'):
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+
+        yield row if type(row) is dict else None
+
+
+def validate_row(form_class, row):
+    if row is None:
+        return 'Неверный формат строки'
+
+    formdata = MultiDict()
+
+    for key, value in row.items():
+        if value is True:
+            value = 'y'
+        elif value is False or value is None:
+            value = ''
+
+        if hasattr(form_class, f'{key}-source'):
+            key = f'{key}-source'
+
+        formdata[key] = str(value)
+
+    form = form_class(formdata=formdata, meta={'csrf': False})
+
+    if not form.validate():
+        return '; '.join(f'{name.removesuffix("-source")}: {errors[0]}' for name, errors in form.errors.items())
+
+    data = {}
+
+    for field in form:
+        if field.name == 'submit':
+            continue
+
+        if field.type == 'BooleanField':
+            if field.data:
+                data[field.name] = 'y'
+            continue
+
+        data[field.name] = field.data
+
+    return collect_data(data, {})
+
+
+def stream_zip(rows, render, workers=4):
+    sink = ZipStream()
+    errors = []
+    pending = {}
+
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='former-batch')
+
+    def write(future):
+        number = pending.pop(future)
+
+        try:
+            zf.writestr(f'document-{number}.docx', future.result())
+        except DocumentError as e:
+            errors.append((number, str(e)))
+        except Exception:
+            logger.exception('Batch row %s failed', number)
+            errors.append((number, 'Что-то пошло не так'))
+
+    try:
+        with zipfile.ZipFile(sink, 'w') as zf:
+            for number, data in rows:
+                if type(data) is str:
+                    errors.append((number, data))
+                    continue
+
+                pending[executor.submit(render, data)] = number
+
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        write(future)
+
+                    yield sink.pop()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    write(future)
+
+                yield sink.pop()
+
+            report = StringIO()
+            writer = csv.writer(report)
+            writer.writerow(('Строка', 'Ошибка'))
+            writer.writerows(sorted(errors))
+
+            zf.writestr('errors.csv', report.getvalue().encode('utf-8-sig'))
+
+        yield sink.pop()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,193 @@
+import json
+import os
+import time
+
+from collections import OrderedDict
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+
+class VersionedCache:
+    def __init__(self, max_entries=None):
+        self._entries = {}
+        self._version = None
+        self._max_entries = max_entries
+        self._lock = Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            if version != self._version:
+                return None
+
+            return self._entries.get(key)
+
+    def put(self, key, version, value):
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._entries.clear()
+                self._version = version
+
+            if version == self._version:
+                self._entries[key] = value
+
+                if self._max_entries and len(self._entries) > self._max_entries:
+                    del self._entries[next(iter(self._entries))]
+
+        return value
+
+
+class DocumentCache:
+    def __init__(self, directory, max_size=268435456):
+        os.makedirs(directory, exist_ok=True)
+
+        self._dir = os.path.abspath(directory)
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = Lock()
+
+        with self._lock:
+            self._scan()
+            self._evict()
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def size(self):
+        return self._size
+
+    @staticmethod
+    def key(template_hash, data, files):
+        h = sha256()
+
+        h.update(template_hash.encode())
+        h.update(json.dumps(data, sort_keys=True, ensure_ascii=False).encode())
+
+        for name, (filename, raw, mimetype) in sorted(files.items()):
+            h.update(name.encode())
+            h.update(sha256(raw).digest())
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._dir, f'{key}.docx')
+
+    def get(self, key):
+        with self._lock:
+            try:
+                file = open(self._path(key), 'rb')
+            except FileNotFoundError:
+                self._size -= self._entries.pop(key, 0)
+                self._misses += 1
+                return None
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = os.fstat(file.fileno()).st_size
+                self._size += self._entries[key]
+
+            self._hits += 1
+
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+        return file
+
+    def put(self, key, chunks):
+        with NamedTemporaryFile(dir=self._dir, suffix='.part', delete=False) as tmp:
+            try:
+                for chunk in chunks:
+                    tmp.write(chunk)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+
+        size = os.path.getsize(tmp.name)
+        os.replace(tmp.name, self._path(key))
+
+        with self._lock:
+            file = open(self._path(key), 'rb')
+
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+        return file
+
+    def stats(self):
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'entries': len(self._entries),
+            'size': self._size
+        }
+
+    def _scan(self):
+        entries = []
+
+        for entry in os.scandir(self._dir):
+            if not entry.name.endswith('.docx'):
+                continue
+
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, entry.name.removesuffix('.docx'), stat.st_size))
+
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self._size = sum(self._entries.values())
+
+    def _evict(self):
+        if self._size > self._max_size:
+            self._scan()
+
+        while self._size > self._max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+class ApprovalCache:
+    def __init__(self, ttl=30.0):
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+
+        if not entry or entry[1] < time.monotonic():
+            return None
+
+        return entry[0]
+
+    def put(self, name, approved):
+        with self._lock:
+            self._entries[name] = (approved, time.monotonic() + self._ttl)
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
@@ -1,111 +1,231 @@
+import json
+import re
 import sqlite3
+import time
+from contextlib import contextmanager
 from hashlib import sha256
+from threading import Lock
+
+from .migrations import migrate, FORM_MIGRATIONS, EDITOR_MIGRATIONS
+
+
+def connect(db, busy_timeout=5000):
+    con = sqlite3.connect(db, autocommit=True, check_same_thread=False)
+
+    cur = con.cursor()
+    cur.execute('PRAGMA journal_mode = WAL')
+    cur.execute(f'PRAGMA busy_timeout = {int(busy_timeout)}')
+    cur.execute('PRAGMA foreign_keys = ON')
+    cur.close()
+
+    return con
+
+
+@contextmanager
+def transaction(con):
+    cur = con.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+
+    try:
+        yield cur
+    except BaseException:
+        cur.execute('ROLLBACK')
+        raise
+    else:
+        cur.execute('COMMIT')
+    finally:
+        cur.close()
+
+
+class ConnectionPool:
+    def __init__(self, db, size=8, busy_timeout=5000, migrations=None):
+        self._db = db
+        self._size = size
+        self._busy_timeout = busy_timeout
+        self._migrations = migrations
+        self._idle = []
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+            if self._migrations:
+                con = connect(self._db, self._busy_timeout)
+
+                try:
+                    migrate(con, self._migrations)
+                except BaseException:
+                    con.close()
+                    raise
+
+                self._migrations = None
+                return con
+
+        return connect(self._db, self._busy_timeout)
+
+    def release(self, con):
+        if con.in_transaction:
+            con.execute('ROLLBACK')
+
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(con)
+                return
+
+        con.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for con in idle:
+            con.close()
+
+    def reset(self):
+        self._idle = []
+        self._lock = Lock()
 
 
 class FormDB:
-    def __init__(self, db):
-        self._con = sqlite3.connect(db, autocommit=True)
+    def __init__(self, con, choices=None):
+        self._con = con
+        self._choices = choices
+
+    @property
+    def connection(self):
+        return self._con
 
+    @property
+    def version(self):
         cur = self._con.cursor()
-        cur.execute('PRAGMA foreign_keys = ON')
+
+        version = cur.execute('SELECT version_catalog, choices_catalog FROM catalog WHERE id_catalog = 1').fetchone()
+
         cur.close()
 
-    def get_choices(self, select_label):
-        choices = []
+        return version
 
+    @property
+    def choices_version(self):
         cur = self._con.cursor()
 
-        rows = cur.execute(
-            '''
-            SELECT
-            name_choice
-            FROM
-            select_field JOIN choice ON select_field.id_select = choice.id_select
-            WHERE
-            label_select = ?
-            ''',
-            (select_label,)
-        ).fetchall()
+        version = cur.execute('SELECT choices_catalog FROM catalog WHERE id_catalog = 1').fetchone()[0]
 
         cur.close()
 
-        for row in rows:
-            choice = row[0]
+        return version
 
-            choices.append(choice)
+    def get_catalog(self):
+        cur = self._con.cursor()
 
-        return choices
+        catalog = cur.execute('SELECT version_catalog, updated_catalog FROM catalog WHERE id_catalog = 1').fetchone()
+
+        cur.close()
+
+        return catalog
 
-    def _get_select_fields(self, form_label):
-        fields = {}
+    def get_choices(self, select_label):
+        return self.get_choices_by_labels([select_label]).get(select_label, [])
 
+    def get_template(self, template_hash):
         cur = self._con.cursor()
 
-        rows = cur.execute(
-            '''
-            SELECT
-            name_select, label_select
-            FROM
-            form
-            JOIN form_select ON form.id_form = form_select.id_form
-            JOIN select_field ON form_select.id_select = select_field.id_select
-            WHERE
-            label_form = ?
-            ''',
-            (form_label,)
-        ).fetchall()
+        doc = cur.execute('SELECT doc_template FROM template WHERE hash_template = ?', (template_hash,)).fetchone()[0]
 
         cur.close()
 
-        for row in rows:
-            select_name = str(row[0])
-            select_label = row[1]
-            choices = self.get_choices(select_label)
+        return doc
 
-            fields[select_name] = {
-                'choices': choices,
-                'label': select_label
-            }
+    def get_choices_by_labels(self, select_labels):
+        choices = {}
 
-        return fields
+        select_labels = list(dict.fromkeys(select_labels))
+
+        if not select_labels:
+            return choices
+
+        if self._choices is not None:
+            version = self.choices_version
+            missing = []
+
+            for select_label in select_labels:
+                if (cached := self._choices.get(select_label, version)) is None:
+                    missing.append(select_label)
+                elif cached:
+                    choices[select_label] = list(cached)
+
+            if not missing:
+                return choices
+
+            loaded = self._load_choices(missing)
+
+            for select_label in missing:
+                self._choices.put(select_label, version, tuple(loaded.get(select_label, ())))
+
+            choices.update(loaded)
+
+            return choices
 
-    def _get_static_fields(self, form_label):
-        fields = {}
+        return self._load_choices(select_labels)
+
+    def _load_choices(self, select_labels):
+        choices = {}
+
+        placeholders = ', '.join('?' * len(select_labels))
 
         cur = self._con.cursor()
 
         rows = cur.execute(
-            '''
+            f'''
             SELECT
-            name_field, type_field, label_field
+            label_select, name_choice
             FROM
-            form JOIN field ON form.id_form = field.id_form WHERE label_form = ?
+            select_field JOIN choice ON select_field.id_select = choice.id_select
+            WHERE
+            label_select IN ({placeholders})
+            ORDER BY id_choice
             ''',
-            (form_label,)
+            select_labels
         ).fetchall()
 
         cur.close()
 
-        for row in rows:
-            field_name = row[0]
-            field_type = row[1]
-            field_label = row[2]
+        for select_label, choice in rows:
+            choices.setdefault(select_label, []).append(choice)
 
-            fields[field_name] = {
-                'type': field_type,
-                'label': field_label
-            }
-
-        return fields
+        return choices
 
-    def get_doc_form(self, form_label):
+    def load_draft(self, draft_id):
         cur = self._con.cursor()
 
-        doc = cur.execute('SELECT doc_form FROM form WHERE label_form = ?', (form_label,)).fetchone()[0]
+        row = cur.execute('SELECT data_draft FROM draft WHERE id_draft = ?', (draft_id,)).fetchone()
 
         cur.close()
 
-        return doc
+        if not row:
+            return None
+
+        return json.loads(row[0])
+
+    def save_draft(self, draft_id, data, ttl=None):
+        now = time.time()
+
+        cur = self._con.cursor()
+
+        cur.execute(
+            '''
+            INSERT INTO draft(id_draft, data_draft, updated_draft) VALUES (?, ?, ?)
+            ON CONFLICT(id_draft) DO UPDATE SET data_draft = excluded.data_draft, updated_draft = excluded.updated_draft
+            ''',
+            (draft_id, json.dumps(data, ensure_ascii=False), now)
+        )
+
+        if ttl:
+            cur.execute('DELETE FROM draft WHERE updated_draft < ?', (now - ttl,))
+
+        cur.close()
 
     def get_select_labels(self):
         cur = self._con.cursor()
@@ -135,41 +255,118 @@ class FormDB:
 
         return forms
 
-    def get_form_by_id(self, form_id):
-        cur = self._con.cursor()
-
-        form_label = cur.execute('SELECT label_form FROM form WHERE id_form = ?', (form_id,)).fetchone()[0]
+    def load_definitions(self, form_ids=None):
+        forms = {}
 
-        cur.close()
+        where = ''
+        params = ()
 
-        fields = {
-            'static_fields': self._get_static_fields(form_label),
-            'select_fields': self._get_select_fields(form_label),
-            'doc_form': self.get_doc_form(form_label)
-        }
+        if form_ids is not None:
+            form_ids = list(form_ids)
 
-        return form_label, fields
+            if not form_ids:
+                return forms
 
-    def get_forms(self):
-        forms = {}
+            placeholders = ', '.join('?' * len(form_ids))
+            where = f'WHERE form.id_form IN ({placeholders})'
+            params = tuple(form_ids) * 2
 
         cur = self._con.cursor()
 
-        rows = cur.execute('SELECT label_form FROM form').fetchall()
+        rows = cur.execute(
+            f'''
+            SELECT
+            form.id_form, label_form, hash_template, 0, id_field, name_field, type_field, label_field
+            FROM
+            form LEFT JOIN field ON form.id_form = field.id_form
+            {where}
+            UNION ALL
+            SELECT
+            form.id_form, label_form, hash_template, 1, id_fs, name_select, NULL, label_select
+            FROM
+            form
+            JOIN form_select ON form.id_form = form_select.id_form
+            JOIN select_field ON form_select.id_select = select_field.id_select
+            {where}
+            ORDER BY 1, 4, 5
+            ''',
+            params
+        ).fetchall()
 
         cur.close()
 
         for row in rows:
-            form_label = row[0]
+            form_id, form_label, template_hash, is_select, field_id, field_name, field_type, field_label = row
+
+            if form_id not in forms:
+                forms[form_id] = (form_label, {
+                    'static_fields': {},
+                    'select_fields': {},
+                    'template': template_hash
+                })
+
+            fields = forms[form_id][1]
+
+            if field_id is None:
+                continue
 
-            forms[form_label] = {
-                'static_fields': self._get_static_fields(form_label),
-                'select_fields': self._get_select_fields(form_label),
-                'doc_form': self.get_doc_form(form_label)
+            if not is_select:
+                fields['static_fields'][field_name] = {
+                    'type': field_type,
+                    'label': field_label
+                }
+                continue
+
+            fields['select_fields'][str(field_name)] = {
+                'choices': [],
+                'label': field_label
             }
 
+        select_labels = [
+            field['label'] for _, fields in forms.values() for field in fields['select_fields'].values()
+        ]
+        choices = self.get_choices_by_labels(select_labels)
+
+        for _, fields in forms.values():
+            for field in fields['select_fields'].values():
+                field['choices'] = list(choices.get(field['label'], []))
+
         return forms
 
+    def search_forms(self, query=None, after=None, limit=50):
+        conditions = []
+        params = []
+
+        tokens = re.findall(r'\w+', query or '')
+
+        if tokens:
+            conditions.append('form.id_form IN (SELECT rowid FROM form_search WHERE form_search MATCH ?)')
+            params.append(' '.join(f'"{token}"*' for token in tokens))
+
+        if after is not None:
+            conditions.append('form.label_form > ?')
+            params.append(after)
+
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+        params.append(limit)
+
+        cur = self._con.cursor()
+
+        rows = cur.execute(
+            f'SELECT id_form, label_form FROM form {where} ORDER BY label_form LIMIT ?',
+            params
+        ).fetchall()
+
+        cur.close()
+
+        return rows
+
+    def get_form_by_id(self, form_id):
+        return self.load_definitions([form_id]).get(form_id)
+
+    def get_forms(self):
+        return dict(self.load_definitions().values())
+
     def delete_select_field(self, select_label):
         cur = self._con.cursor()
 
@@ -186,22 +383,19 @@ class FormDB:
         return True
 
     def save_select_field(self, select_label, choices):
-        cur = self._con.cursor()
-
-        cur.execute(
-            'INSERT INTO select_field(label_select) VALUES (?)',
-            (select_label,)
-        )
-
-        select_id = cur.execute(
-            'SELECT id_select FROM select_field WHERE label_select = ?',
-            (select_label,)
-        ).fetchone()[0]
+        with transaction(self._con) as cur:
+            cur.execute(
+                'INSERT INTO select_field(label_select) VALUES (?)',
+                (select_label,)
+            )
 
-        choice_data = list(map(lambda choice: (select_id, choice), choices))
-        cur.executemany('INSERT INTO choice(id_select, name_choice) VALUES (?, ?)', choice_data)
+            select_id = cur.execute(
+                'SELECT id_select FROM select_field WHERE label_select = ?',
+                (select_label,)
+            ).fetchone()[0]
 
-        cur.close()
+            choice_data = list(map(lambda choice: (select_id, choice), choices))
+            cur.executemany('INSERT INTO choice(id_select, name_choice) VALUES (?, ?)', choice_data)
 
     def _save_static_field(self, form_label, field_name, field_type, field_label):
         cur = self._con.cursor()
@@ -250,125 +444,109 @@ class FormDB:
         cur.close()
         return True
 
-    def save_form(self, form_label, fields):
+    def _save_template(self, doc):
+        template_hash = sha256(doc).hexdigest()
+
         cur = self._con.cursor()
 
-        cur.execute('INSERT INTO form(label_form, doc_form) VALUES (?, ?)', (form_label, sqlite3.Binary(fields['doc_form'])))
+        cur.execute(
+            'INSERT OR IGNORE INTO template(hash_template, doc_template) VALUES (?, ?)',
+            (template_hash, sqlite3.Binary(doc))
+        )
 
-        if 'static_fields' in fields:
-            for field_name, field_data in fields['static_fields'].items():
-                self._save_static_field(form_label, field_name, field_data['type'], field_data['label'])
+        cur.close()
 
-        if 'select_fields' in fields:
-            for field_name, field_data in fields['select_fields'].items():
-                self._link_form_select(form_label, field_data['label'], field_name)
+        return template_hash
 
-        cur.close()
+    def save_form(self, form_label, fields):
+        with transaction(self._con) as cur:
+            template_hash = self._save_template(fields['doc_form'])
 
-    def initialize(self):
-        cur = self._con.cursor()
+            cur.execute('INSERT INTO form(label_form, hash_template) VALUES (?, ?)', (form_label, template_hash))
 
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS form (
-        id_form INTEGER PRIMARY KEY AUTOINCREMENT,
-        label_form TEXT UNIQUE NOT NULL,
-        doc_form BLOB NOT NULL
-        )
-        ''')
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS select_field (
-        id_select INTEGER PRIMARY KEY AUTOINCREMENT,
-        label_select TEXT UNIQUE NOT NULL
-        )
-        ''')
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS field (
-        id_field INTEGER PRIMARY KEY AUTOINCREMENT,
-        id_form INTEGER REFERENCES form(id_form) ON DELETE CASCADE NOT NULL,
-        name_field TEXT NOT NULL,
-        type_field INTEGER NOT NULL,
-        label_field TEXT NOT NULL
-        )
-        ''')
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS choice (
-        id_choice INTEGER PRIMARY KEY AUTOINCREMENT,
-        id_select INTEGER REFERENCES select_field(id_select) ON DELETE CASCADE NOT NULL,
-        name_choice TEXT NOT NULL
-        )
-        ''')
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS form_select (
-        id_fs INTEGER PRIMARY KEY AUTOINCREMENT,
-        id_form INTEGER REFERENCES form(id_form) ON DELETE CASCADE NOT NULL,
-        id_select INTEGER REFERENCES select_field(id_select) ON DELETE RESTRICT NOT NULL,
-        name_select TEXT NOT NULL
-        )
-        ''')
+            if 'static_fields' in fields:
+                for field_name, field_data in fields['static_fields'].items():
+                    self._save_static_field(form_label, field_name, field_data['type'], field_data['label'])
 
-        cur.close()
+            if 'select_fields' in fields:
+                for field_name, field_data in fields['select_fields'].items():
+                    self._link_form_select(form_label, field_data['label'], field_name)
+
+    def initialize(self):
+        migrate(self._con, FORM_MIGRATIONS)
 
 
 class EditorDB:
-    def __init__(self, db):
-        self._con = sqlite3.connect(db, autocommit=True)
+    def __init__(self, con, approvals=None):
+        self._con = con
+        self._approvals = approvals
 
-    def register(self, name, password):
-        if self.search(name):
-            return False
+    @property
+    def connection(self):
+        return self._con
 
+    def _invalidate(self, name=None):
+        if self._approvals:
+            self._approvals.invalidate(name)
+
+    def _existing(self, cur, names):
+        found = set()
+
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+
+            found.update(row[0] for row in cur.execute(f'SELECT name FROM editor WHERE name IN ({placeholders})', chunk))
+
+        return found
+
+    def register(self, name, password):
         hash_str = sha256(password.encode()).hexdigest()
 
         cur = self._con.cursor()
 
-        cur.execute(
-            'INSERT INTO editor(name, password) VALUES (?, ?)',
-            (name, hash_str)
-        )
-
-        cur.close()
+        try:
+            cur.execute(
+                'INSERT INTO editor(name, password) VALUES (?, ?)',
+                (name, hash_str)
+            )
+        except sqlite3.IntegrityError:
+            return False
+        finally:
+            cur.close()
 
         return True
 
     def authenticate(self, name, password):
-        if not self.search(name):
-            return False
-
         hash_str = sha256(password.encode()).hexdigest()
 
         cur = self._con.cursor()
 
-        stored_hash = cur.execute(
-            'SELECT password FROM editor WHERE name=?',
+        editor = cur.execute(
+            'SELECT password, approved FROM editor WHERE name=?',
             (name,)
-        ).fetchone()[0]
+        ).fetchone()
 
         cur.close()
 
-        if hash_str == stored_hash:
-            return True
+        if not editor or hash_str != editor[0]:
+            return None
 
-        return False
+        return bool(editor[1])
 
     def is_approved(self, name):
-        if not self.search(name):
-            return False
-
         cur = self._con.cursor()
 
-        approved = cur.execute(
+        editor = cur.execute(
             'SELECT approved FROM editor WHERE name=?',
             (name,)
-        ).fetchone()[0]
+        ).fetchone()
 
         cur.close()
 
-        return bool(approved)
+        return bool(editor and editor[0])
 
     def approve(self, name):
-        if not self.search(name):
-            return False
-
         cur = self._con.cursor()
 
         cur.execute(
@@ -376,14 +554,15 @@ class EditorDB:
             (name,)
         )
 
+        found = cur.rowcount > 0
+
         cur.close()
 
-        return True
+        self._invalidate(name)
 
-    def delete(self, name):
-        if not self.search(name):
-            return False
+        return found
 
+    def delete(self, name):
         cur = self._con.cursor()
 
         cur.execute(
@@ -391,17 +570,49 @@ class EditorDB:
             (name,)
         )
 
+        found = cur.rowcount > 0
+
         cur.close()
 
-        return True
+        self._invalidate(name)
+
+        return found
+
+    def approve_many(self, names):
+        names = list(dict.fromkeys(names))
+
+        with transaction(self._con) as cur:
+            found = self._existing(cur, names)
+            cur.executemany('UPDATE editor SET approved = 1 WHERE name=?', [(name,) for name in names if name in found])
+
+        self._invalidate()
+
+        return [name for name in names if name in found]
+
+    def delete_many(self, names):
+        names = list(dict.fromkeys(names))
+
+        with transaction(self._con) as cur:
+            found = self._existing(cur, names)
+            cur.executemany('DELETE FROM editor WHERE name=?', [(name,) for name in names if name in found])
+
+        self._invalidate()
+
+        return [name for name in names if name in found]
 
     def delete_all_nonapproved(self):
         cur = self._con.cursor()
 
         cur.execute('DELETE FROM editor WHERE approved=0')
 
+        deleted = cur.rowcount
+
         cur.close()
 
+        self._invalidate()
+
+        return deleted
+
     def search(self, name):
         cur = self._con.cursor()
 
@@ -421,14 +632,4 @@ class EditorDB:
         return rows
 
     def initialize(self):
-        cur = self._con.cursor()
-
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS editor (
-        name TEXT PRIMARY KEY,
-        password TEXT NOT NULL,
-        approved INTEGER NOT NULL CHECK (approved IN (0, 1)) DEFAULT (0)
-        )
-        ''')
-
-        cur.close()
+        migrate(self._con, EDITOR_MIGRATIONS)
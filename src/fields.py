@@ -0,0 +1,46 @@
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+from wtforms.fields.choices import SelectField
+from wtforms.fields.simple import StringField, BooleanField, TextAreaField
+from wtforms.validators import InputRequired
+
+from .utils import Fields
+
+
+fields = Fields(
+    default_data={
+        'class': SelectField,
+        'kwargs': {
+            'validators': [InputRequired()]
+        }
+    },
+    Bool={
+        'class': BooleanField,
+    },
+    Text={
+        'class': StringField,
+        'kwargs': {
+            'validators': [InputRequired()]
+        }
+    },
+    TextArea={
+        'class': TextAreaField,
+        'kwargs': {
+            'validators': [InputRequired()],
+        },
+        'type': 'html'
+    },
+    File={
+        'class': FileField,
+        'kwargs': {
+            'validators': [FileRequired(), FileAllowed(['png', 'jpg'])]
+        },
+        'type': 'image'
+    }
+)
+
+predefined_fields = [
+    (fields.type.Bool, 'Флажок'),
+    (fields.type.Text, 'Текстовое поле'),
+    (fields.type.TextArea, 'Поле для HTML'),
+    (fields.type.File, 'Картинка')
+]
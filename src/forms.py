@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileAllowed
+from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, SubmitField
 from wtforms.fields.choices import SelectField
 from wtforms.fields.simple import PasswordField
@@ -7,14 +7,25 @@ from wtforms.validators import InputRequired, Regexp
 
 import re
 
+from .cache import VersionedCache
 
-def create_form(fields, *args, **kwargs):
+
+def build_form(fields):
     class CustomForm(FlaskForm): pass
 
     for field_name, field in fields.items():
         setattr(CustomForm, field_name, field)
 
-    return CustomForm(*args, **kwargs)
+    return CustomForm
+
+
+def create_form(fields, *args, **kwargs):
+    return build_form(fields)(*args, **kwargs)
+
+
+class FormCache(VersionedCache):
+    def put(self, form_id, version, form_label, template, form_class):
+        return super().put(form_id, version, (form_label, template, form_class))
 
 
 def create_editor(choices, *args, **kwargs):
@@ -57,3 +68,11 @@ class AuthForm(FlaskForm):
     repeat_pass = PasswordField('Повторите пароль')
     send_rq = SubmitField('Отправить запрос на доступ')
     authorize = SubmitField('Авторизация')
+
+
+class BatchForm(FlaskForm):
+    rows = FileField('Данные', validators=[
+        FileRequired(message='Не приложен файл с данными'),
+        FileAllowed(['csv', 'jsonl'], message='Формат данных должен быть .csv или .jsonl')
+    ])
+    send = SubmitField('Создать документы')
@@ -0,0 +1,146 @@
+import logging
+import os
+import re
+import secrets
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from .utils import DocumentError
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = 'pending'
+        self.error = None
+        self.updated = time.time()
+
+
+class JobQueue:
+    def __init__(self, directory, workers=4, queue_size=32, ttl=600):
+        os.makedirs(directory, exist_ok=True)
+
+        self._dir = os.path.abspath(directory)
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='former-job')
+        self._queue_size = queue_size
+        self._ttl = ttl
+        self._jobs = {}
+        self._pending = 0
+        self._lock = Lock()
+
+    def path(self, job_id):
+        if not re.fullmatch(r'[\w-]+', job_id):
+            return None
+
+        return os.path.join(self._dir, f'{job_id}.docx')
+
+    def submit(self, fn, *args):
+        self.expire()
+
+        with self._lock:
+            if self._pending >= self._queue_size:
+                raise QueueFull()
+
+            self._pending += 1
+
+            job = Job(secrets.token_urlsafe(16))
+            self._jobs[job.id] = job
+
+        open(f'{self.path(job.id)}.part', 'wb').close()
+
+        self._executor.submit(self._run, job, fn, args)
+
+        return job.id
+
+    def get(self, job_id):
+        self.expire()
+
+        with self._lock:
+            if job := self._jobs.get(job_id):
+                return job
+
+        if not (path := self.path(job_id)):
+            return None
+
+        job = Job(job_id)
+
+        if os.path.exists(path):
+            job.status = 'done'
+            job.updated = os.path.getmtime(path)
+            return job
+
+        if os.path.exists(f'{path}.error'):
+            with open(f'{path}.error', encoding='utf-8') as f:
+                job.error = f.read()
+            job.status = 'failed'
+            return job
+
+        if os.path.exists(f'{path}.part'):
+            return job
+
+        return None
+
+    def expire(self):
+        deadline = time.time() - self._ttl
+
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job.status != 'pending' and job.updated < deadline]
+
+            for job_id in expired:
+                del self._jobs[job_id]
+
+        for entry in os.scandir(self._dir):
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def reset(self):
+        self._executor = ThreadPoolExecutor(self._workers, thread_name_prefix='former-job')
+        self._jobs = {}
+        self._pending = 0
+        self._lock = Lock()
+
+    def _run(self, job, fn, args):
+        path = self.path(job.id)
+        part = f'{path}.part'
+
+        try:
+            with open(part, 'wb') as out:
+                fn(out, *args)
+
+            os.replace(part, path)
+            job.status = 'done'
+        except DocumentError as e:
+            job.status = 'failed'
+            job.error = str(e)
+        except Exception:
+            logger.exception('Job %s failed', job.id)
+            job.status = 'failed'
+            job.error = 'Что-то пошло не так'
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+            if job.status == 'failed':
+                with open(f'{path}.error', 'w', encoding='utf-8') as f:
+                    f.write(job.error)
+
+            job.updated = time.time()
+
+            with self._lock:
+                self._pending -= 1
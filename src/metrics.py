@@ -0,0 +1,141 @@
+import os
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self._labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(_escape(labels[name]) for name in self._labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = dict(self._values)
+
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self._labels, key, extra)} {value}'
+
+
+class Callback:
+    def __init__(self, name, description, fn, type='gauge'):
+        self.name = name
+        self.description = description
+        self.type = type
+        self._fn = fn
+
+    def samples(self, extra=()):
+        yield f'{self.name}{_labels((), (), extra)} {self._fn()}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self._labels = labels
+        self._buckets = buckets
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(_escape(labels[name]) for name in self._labels)
+        index = bisect_left(self._buckets, value)
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self._buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, extra=()):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+
+            for bound, count in zip(self._buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _labels(self._labels, key, list(extra) + [('le', bound)])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+
+            yield f'{self.name}_sum{_labels(self._labels, key, extra)} {total}'
+            yield f'{self.name}_count{_labels(self._labels, key, extra)} {cumulative}'
+
+
+class Metrics:
+    def __init__(self):
+        self._metrics = []
+
+        self.phases = self.add(Histogram(
+            'former_phase_seconds', 'Time spent in each phase of a form request', labels=('phase',)
+        ))
+        self.dfs_requests = self.add(Histogram(
+            'former_dfs_request_seconds', 'DFS request latency', labels=('path',)
+        ))
+        self.dfs_errors = self.add(Counter(
+            'former_dfs_errors_total', 'DFS requests that failed', labels=('path', 'kind')
+        ))
+        self.dfs_timeouts = self.add(Counter(
+            'former_dfs_timeouts_total', 'DFS requests that timed out', labels=('path',)
+        ))
+        self.template_bytes_saved = self.add(Counter(
+            'former_dfs_template_bytes_saved_total', 'Template bytes not uploaded because DFS already had them'
+        ))
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def phase(self, name):
+        return self.phases.time(phase=name)
+
+    def render(self):
+        lines = []
+        extra = [('pid', os.getpid())]
+
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.samples(extra))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,261 @@
+import time
+
+from hashlib import sha256
+
+
+def migrate(con, migrations):
+    for version, migration in enumerate(migrations, 1):
+        cur = con.cursor()
+
+        if cur.execute('PRAGMA user_version').fetchone()[0] >= version:
+            cur.close()
+            continue
+
+        cur.execute('BEGIN IMMEDIATE')
+
+        try:
+            if cur.execute('PRAGMA user_version').fetchone()[0] < version:
+                migration(cur)
+                cur.execute(f'PRAGMA user_version = {version}')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        else:
+            cur.execute('COMMIT')
+        finally:
+            cur.close()
+
+
+def create_form_tables(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS template (
+    hash_template TEXT PRIMARY KEY,
+    doc_template BLOB NOT NULL,
+    refs_template INTEGER NOT NULL DEFAULT (0)
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS form (
+    id_form INTEGER PRIMARY KEY AUTOINCREMENT,
+    label_form TEXT UNIQUE NOT NULL,
+    hash_template TEXT REFERENCES template(hash_template) NOT NULL
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS select_field (
+    id_select INTEGER PRIMARY KEY AUTOINCREMENT,
+    label_select TEXT UNIQUE NOT NULL
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS field (
+    id_field INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_form INTEGER REFERENCES form(id_form) ON DELETE CASCADE NOT NULL,
+    name_field TEXT NOT NULL,
+    type_field INTEGER NOT NULL,
+    label_field TEXT NOT NULL
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS choice (
+    id_choice INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_select INTEGER REFERENCES select_field(id_select) ON DELETE CASCADE NOT NULL,
+    name_choice TEXT NOT NULL
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS form_select (
+    id_fs INTEGER PRIMARY KEY AUTOINCREMENT,
+    id_form INTEGER REFERENCES form(id_form) ON DELETE CASCADE NOT NULL,
+    id_select INTEGER REFERENCES select_field(id_select) ON DELETE RESTRICT NOT NULL,
+    name_select TEXT NOT NULL
+    )
+    ''')
+
+
+def move_templates(cur):
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(form)').fetchall()]
+
+    if 'doc_form' not in columns:
+        return
+
+    cur.execute('ALTER TABLE form ADD COLUMN hash_template TEXT REFERENCES template(hash_template)')
+
+    form_ids = [row[0] for row in cur.execute('SELECT id_form FROM form').fetchall()]
+
+    for form_id in form_ids:
+        doc = cur.execute('SELECT doc_form FROM form WHERE id_form = ?', (form_id,)).fetchone()[0]
+        template_hash = sha256(doc).hexdigest()
+
+        cur.execute(
+            'INSERT OR IGNORE INTO template(hash_template, doc_template) VALUES (?, ?)',
+            (template_hash, doc)
+        )
+        cur.execute(
+            'UPDATE form SET hash_template = ? WHERE id_form = ?',
+            (template_hash, form_id)
+        )
+
+    cur.execute('ALTER TABLE form DROP COLUMN doc_form')
+    cur.execute('''
+    UPDATE template SET refs_template = (
+    SELECT count(*) FROM form WHERE form.hash_template = template.hash_template
+    )
+    ''')
+
+
+def count_template_refs(cur):
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS form_template_ref AFTER INSERT ON form
+    BEGIN
+    UPDATE template SET refs_template = refs_template + 1 WHERE hash_template = NEW.hash_template;
+    END
+    ''')
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS form_template_unref AFTER DELETE ON form
+    BEGIN
+    UPDATE template SET refs_template = refs_template - 1 WHERE hash_template = OLD.hash_template;
+    DELETE FROM template WHERE hash_template = OLD.hash_template AND refs_template <= 0;
+    END
+    ''')
+
+
+def create_drafts(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS draft (
+    id_draft TEXT PRIMARY KEY,
+    data_draft TEXT NOT NULL,
+    updated_draft REAL NOT NULL
+    )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS draft_updated ON draft(updated_draft)')
+
+
+def create_catalog(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS catalog (
+    id_catalog INTEGER PRIMARY KEY CHECK (id_catalog = 1),
+    version_catalog INTEGER NOT NULL,
+    updated_catalog REAL NOT NULL
+    )
+    ''')
+    cur.execute('INSERT OR IGNORE INTO catalog VALUES (1, 0, ?)', (time.time(),))
+
+    for table in ('form', 'select_field'):
+        for event in ('INSERT', 'DELETE'):
+            cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_catalog AFTER {event} ON {table}
+            BEGIN
+            UPDATE catalog SET
+            version_catalog = version_catalog + 1,
+            updated_catalog = (julianday('now') - 2440587.5) * 86400.0
+            WHERE id_catalog = 1;
+            END
+            ''')
+
+
+def create_search_index(cur):
+    labels = '''
+    coalesce((
+    SELECT group_concat(label_field || ' ' || name_field, ' ') FROM field WHERE field.id_form = {id}
+    ), '') || ' ' || coalesce((
+    SELECT group_concat(label_select || ' ' || name_select, ' ')
+    FROM form_select JOIN select_field ON form_select.id_select = select_field.id_select
+    WHERE form_select.id_form = {id}
+    ), '')
+    '''
+
+    exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'form_search'").fetchone()
+
+    cur.execute('CREATE VIRTUAL TABLE IF NOT EXISTS form_search USING fts5(label_form, labels_form)')
+
+    if not exists:
+        cur.execute(f'''
+        INSERT INTO form_search(rowid, label_form, labels_form)
+        SELECT id_form, label_form, {labels.format(id='form.id_form')} FROM form
+        ''')
+
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS form_insert_search AFTER INSERT ON form
+    BEGIN
+    INSERT INTO form_search(rowid, label_form, labels_form) VALUES (NEW.id_form, NEW.label_form, '');
+    END
+    ''')
+    cur.execute('''
+    CREATE TRIGGER IF NOT EXISTS form_delete_search AFTER DELETE ON form
+    BEGIN
+    DELETE FROM form_search WHERE rowid = OLD.id_form;
+    END
+    ''')
+
+    for table in ('field', 'form_select'):
+        for event, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+            cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_search AFTER {event} ON {table}
+            BEGIN
+            UPDATE form_search SET labels_form = {labels.format(id=f'{row}.id_form')} WHERE rowid = {row}.id_form;
+            END
+            ''')
+
+    cur.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS select_field_update_search AFTER UPDATE OF label_select ON select_field
+    BEGIN
+    UPDATE form_search SET labels_form = {labels.format(id='form_search.rowid')}
+    WHERE rowid IN (SELECT id_form FROM form_select WHERE id_select = NEW.id_select);
+    END
+    ''')
+
+
+def create_form_indexes(cur):
+    cur.execute('CREATE INDEX IF NOT EXISTS form_template ON form(hash_template)')
+    cur.execute('CREATE INDEX IF NOT EXISTS field_form ON field(id_form, id_field, name_field, type_field, label_field)')
+    cur.execute('CREATE INDEX IF NOT EXISTS form_select_form ON form_select(id_form, id_fs, id_select, name_select)')
+    cur.execute('CREATE INDEX IF NOT EXISTS form_select_select ON form_select(id_select)')
+    cur.execute('CREATE INDEX IF NOT EXISTS choice_select ON choice(id_select, id_choice, name_choice)')
+
+
+def count_choice_changes(cur):
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(catalog)').fetchall()]
+
+    if 'choices_catalog' not in columns:
+        cur.execute('ALTER TABLE catalog ADD COLUMN choices_catalog INTEGER NOT NULL DEFAULT (0)')
+
+    for table, events in (('choice', ('INSERT', 'UPDATE', 'DELETE')), ('select_field', ('UPDATE', 'DELETE'))):
+        for event in events:
+            cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_choices AFTER {event} ON {table}
+            BEGIN
+            UPDATE catalog SET choices_catalog = choices_catalog + 1 WHERE id_catalog = 1;
+            END
+            ''')
+
+
+def create_editor_tables(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS editor (
+    name TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    approved INTEGER NOT NULL CHECK (approved IN (0, 1)) DEFAULT (0)
+    )
+    ''')
+
+
+def create_editor_indexes(cur):
+    cur.execute('CREATE INDEX IF NOT EXISTS editor_approved ON editor(approved, name)')
+
+
+FORM_MIGRATIONS = [
+    create_form_tables,
+    move_templates,
+    count_template_refs,
+    create_drafts,
+    create_catalog,
+    create_search_index,
+    create_form_indexes,
+    count_choice_changes,
+]
+
+EDITOR_MIGRATIONS = [
+    create_editor_tables,
+    create_editor_indexes,
+]
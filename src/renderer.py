@@ -0,0 +1,245 @@
+import html
+import logging
+import multiprocessing
+import re
+import requests.exceptions
+import time
+import zipfile
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from jinja2 import TemplateError
+from jinja2.sandbox import ImmutableSandboxedEnvironment, SecurityError
+from markupsafe import Markup
+
+from .utils import BufferedResponse
+
+
+logger = logging.getLogger(__name__)
+
+PARTS = re.compile(r'word/(document|header\d*|footer\d*)\.xml')
+TAG = re.compile(r'\{(?:<[^>]+>)*([{%])(.*?)([%}])(?:<[^>]+>)*\}', re.S)
+XML_TAG = re.compile(r'<[^>]+>')
+HTML_BREAK = re.compile(r'<br\s*/?>|</p>|</div>|</li>', re.I)
+
+RELATIONSHIP_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+EMU_PER_PIXEL = 9525
+
+DRAWING = (
+    '</w:t></w:r><w:r><w:drawing>'
+    '<wp:inline xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+    'distT="0" distB="0" distL="0" distR="0">'
+    '<wp:extent cx="{cx}" cy="{cy}"/>'
+    '<wp:docPr id="{id}" name="Picture {id}"/>'
+    '<a:graphic xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main">'
+    '<a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:nvPicPr><pic:cNvPr id="{id}" name="{name}"/><pic:cNvPicPr/></pic:nvPicPr>'
+    '<pic:blipFill>'
+    '<a:blip xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" r:embed="{rid}"/>'
+    '<a:stretch><a:fillRect/></a:stretch>'
+    '</pic:blipFill>'
+    '<pic:spPr>'
+    '<a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+    '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom>'
+    '</pic:spPr>'
+    '</pic:pic></a:graphicData></a:graphic></wp:inline>'
+    '</w:drawing></w:r><w:r><w:t xml:space="preserve">'
+)
+LINE_BREAK = '</w:t><w:br/><w:t xml:space="preserve">'
+
+_env = None
+
+
+def merge_runs(xml):
+    def merge(m):
+        return '{' + m.group(1) + html.unescape(XML_TAG.sub('', m.group(2))) + m.group(3) + '}'
+
+    return TAG.sub(merge, xml)
+
+
+def html_to_runs(source):
+    text = html.unescape(XML_TAG.sub('', HTML_BREAK.sub('\n', source))).strip()
+
+    return Markup(LINE_BREAK).join(text.split('\n'))
+
+
+class Part:
+    def __init__(self, name, rels):
+        self.name = name
+        self.rels = rels
+        self.media = {}
+        self.rids = {}
+        self.next_rid = 1
+
+    def add_image(self, filename, raw):
+        if filename in self.rids:
+            return self.rids[filename]
+
+        self.media[filename] = raw
+        rid = self.rids[filename] = f'rIdFormer{self.next_rid}'
+        self.next_rid += 1
+
+        self.rels = self.rels.replace(
+            '</Relationships>',
+            f'<Relationship Id="{rid}" Type="{RELATIONSHIP_TYPE}" Target="media/former-{filename}"/></Relationships>'
+        )
+
+        return rid
+
+
+class InlineImage:
+    part = None
+    next_id = 1000
+
+    def __init__(self, filename, raw, width, height):
+        self.filename = filename
+        self.raw = raw
+        self.width = int(width)
+        self.height = int(height)
+
+    def __html__(self):
+        rid = self.part.add_image(self.filename, self.raw)
+        InlineImage.next_id += 1
+
+        return DRAWING.format(
+            cx=self.width * EMU_PER_PIXEL,
+            cy=self.height * EMU_PER_PIXEL,
+            id=InlineImage.next_id,
+            name=html.escape(self.filename),
+            rid=rid
+        )
+
+
+def build_context(data, files):
+    context = {}
+
+    for name, value in data.items():
+        if type(value) is not dict:
+            context[name] = value
+        elif value.get('__type') == 'image':
+            _, raw, _ = files[value['source']]
+            context[name] = InlineImage(value['source'], raw, value['__width'], value['__height'])
+        elif value.get('__type') == 'html':
+            context[name] = html_to_runs(value.get('source', ''))
+        else:
+            context[name] = value.get('source', '')
+
+    return context
+
+
+def render(doc_form, data, files):
+    global _env
+
+    if _env is None:
+        _env = ImmutableSandboxedEnvironment(autoescape=True)
+
+    context = build_context(data, files)
+    images = [value for value in context.values() if isinstance(value, InlineImage)]
+    media = {}
+    out = BytesIO()
+
+    with zipfile.ZipFile(BytesIO(doc_form)) as src, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as dst:
+        names = src.namelist()
+        rendered = {}
+
+        for name in names:
+            if not PARTS.fullmatch(name):
+                continue
+
+            rels_name = name.replace('word/', 'word/_rels/', 1) + '.rels'
+            rels = src.read(rels_name).decode() if rels_name in names else (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"></Relationships>'
+            )
+
+            part = Part(name, rels)
+
+            for image in images:
+                image.part = part
+
+            rendered[name] = _env.from_string(merge_runs(src.read(name).decode())).render(context)
+
+            if part.media:
+                rendered[rels_name] = part.rels
+                media.update(part.media)
+
+        for name in names:
+            if name == '[Content_Types].xml' and media:
+                types = src.read(name).decode()
+
+                for extension in {filename.rsplit('.', 1)[-1] for filename in media}:
+                    if f'Extension="{extension}"' not in types:
+                        types = types.replace(
+                            '</Types>',
+                            f'<Default Extension="{extension}" ContentType="image/{extension}"/></Types>'
+                        )
+
+                dst.writestr(name, types)
+            elif name in rendered:
+                dst.writestr(name, rendered.pop(name))
+            else:
+                dst.writestr(src.getinfo(name), src.read(name))
+
+        for name, content in rendered.items():
+            dst.writestr(name, content)
+
+        for filename, raw in media.items():
+            dst.writestr(f'word/media/former-{filename}', raw)
+
+    return out.getvalue()
+
+
+class LocalRenderer:
+    def __init__(self, workers=4, timeout=60.0, metrics=None):
+        self._workers = workers
+        self._timeout = timeout
+        self._metrics = metrics
+        self._executor = self._new_executor()
+
+    @property
+    def url(self):
+        return 'local'
+
+    def health_check(self):
+        return True
+
+    def send_template(self, doc_form, data, files, stream=False, template_hash=None):
+        start = time.perf_counter()
+
+        try:
+            content = self._executor.submit(render, doc_form, data, files).result(timeout=self._timeout)
+        except TimeoutError:
+            if self._metrics:
+                self._metrics.dfs_timeouts.inc(path='local')
+            raise requests.exceptions.Timeout()
+        except BrokenProcessPool:
+            if self._metrics:
+                self._metrics.dfs_errors.inc(path='local', kind='connection')
+            self._executor = self._new_executor()
+            raise requests.exceptions.ConnectionError()
+        except (TemplateError, SecurityError, zipfile.BadZipFile, KeyError, UnicodeDecodeError):
+            logger.exception('Local rendering failed')
+            if self._metrics:
+                self._metrics.dfs_errors.inc(path='local', kind='status')
+            return BufferedResponse(status_code=500)
+        finally:
+            elapsed = time.perf_counter() - start
+
+            logger.info('Local render took %.3f s', elapsed)
+
+            if self._metrics:
+                self._metrics.dfs_requests.observe(elapsed, path='local')
+
+        return BufferedResponse(content)
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context('forkserver'))
+
+    def reset(self):
+        self._executor = self._new_executor()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -1,48 +1,125 @@
 import requests.exceptions
+import secrets
+import time
 
-from flask import Blueprint, request, flash, g, session, redirect, url_for, render_template, send_file, abort
+from flask import Blueprint, Response, make_response, request, flash, g, session, redirect, url_for, render_template, send_file, stream_with_context, abort
 
 from wtforms.fields.choices import SelectField
 from wtforms.fields.simple import SubmitField
 
 from io import BytesIO
-from PIL import Image
-
 from sqlite3 import IntegrityError
 
-from .utils import get_editor_choices, generate_fields, flash_errors, send_template, health_check, img_to_bytes
-from .forms import create_form, create_editor, SaveFormForm, SelectFieldEditor, SaveSelectField, AuthForm
+from .utils import get_editor_choices, generate_fields, flash_errors, stream_document, collect_data, prepare_images, detach_images, generate_document, DOCX_MIMETYPE
+from .jobs import QueueFull
+from .batch import read_rows, validate_row, stream_zip
+from .forms import build_form, create_form, create_editor, SaveFormForm, SelectFieldEditor, SaveSelectField, AuthForm, BatchForm
+
+
+def is_editor():
+    if g.editor_access:
+        return True
+
+    if not session.get('authorized') or not (name := session.get('editor')):
+        return False
+
+    if (approved := g.approvals.get(name)) is None:
+        approved = g.editors.is_approved(name)
+        g.approvals.put(name, approved)
+
+    return approved
 
 
 index_page = Blueprint('index_page', 'index_page', template_folder='templates')
 @index_page.get('/')
 @index_page.get('/forms')
 def index():
-    editor_mode = bool(g.editor_access or session.get('authorized'))
-    forms = {}
+    editor_mode = is_editor()
+    query = request.args.get('q', '').strip()
+    after = request.args.get('after')
+    version, updated = g.db.get_catalog()
+
+    key = (editor_mode, query, after)
+
+    if not (page := g.index_cache.get(key, version)):
+        rows = g.db.search_forms(query, after, g.page_size + 1)
+        forms = {}
+
+        for form_id, form_label in rows[:g.page_size]:
+            forms[form_label] = form_id
+
+        next_after = rows[g.page_size - 1][1] if len(rows) > g.page_size else None
+
+        page = g.index_cache.put(
+            key, version,
+            render_template(
+                'index.html', forms=forms, query=query, next_after=next_after,
+                editor_mode=editor_mode, editor_access=g.editor_access
+            )
+        )
+
+    response = make_response(page)
+    response.set_etag(f'{version}-{int(editor_mode)}')
+    response.last_modified = updated
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+
+    return response.make_conditional(request)
+
+
+def load_form(form_id):
+    with g.metrics.phase('db_load'):
+        version = g.db.version
+
+        if cached := g.form_cache.get(form_id, version):
+            return cached
+
+        definition = g.db.get_form_by_id(form_id)
+
+    if not definition:
+        return None
 
-    for form_label, form_id in g.db.get_forms_data().items():
-        forms[form_label] = form_id
+    with g.metrics.phase('field_generation'):
+        form_label, form_fields = definition
 
-    return render_template('index.html', forms=forms, editor_mode=editor_mode, editor_access=g.editor_access)
+        template = form_fields['template']
+        form_fields = generate_fields(form_fields, g.fields)
+        form_fields['submit'] = SubmitField('Отправить')
+
+        return g.form_cache.put(form_id, version, form_label, template, build_form(form_fields))
+
+
+def timed_send(response):
+    metrics = g.metrics
+    start = time.perf_counter()
+
+    response.call_on_close(lambda: metrics.phases.observe(time.perf_counter() - start, phase='response_send'))
+
+    return response
 
 
 form_page = Blueprint('form_page', 'form_page', template_folder='templates')
 @form_page.route('/forms/<int:form_id>', methods=['GET', 'POST'])
 def show(form_id):
-    form_label, form_fields = g.db.get_form_by_id(form_id)
+    if not (cached := load_form(form_id)):
+        return abort(404)
 
-    form_fields = generate_fields(form_fields, g.fields)
-    form_fields['submit'] = SubmitField('Отправить')
-
-    form = create_form(form_fields)
+    form_label, template, form_class = cached
+    form = form_class()
 
     if request.method == 'GET':
-        if not health_check(g.dfs_url):
+        if g.dfs_health.is_down:
             flash('Не удалось подключиться к API')
-        return render_template('form.html', form=form, form_label=form_label)
+        return render_template('form.html', form=form, form_label=form_label, form_id=form_id)
+
+    if g.dfs_health.is_down:
+        flash('Не удалось подключиться к API')
+        return redirect(url_for('form_page.show', form_id=form_id))
+
+    with g.metrics.phase('validation'):
+        valid = form.validate_on_submit()
 
-    if not form.validate_on_submit():
+    if not valid:
         flash_errors(form)
         return redirect(url_for('form_page.show', form_id=form_id))
 
@@ -51,67 +128,180 @@ def show(form_id):
     del form_data['csrf_token']
     del form_data['submit']
 
-    data = {}
+    data = collect_data(form_data, form_files)
 
-    it = list(form_data.items())
-    it.extend(list(form_files.items()))
+    if g.jobs:
+        detach_images(data)
 
-    for key, value in it:
-        if '-' in key:
-            var_name, var_type = tuple(key.split('-'))
+        try:
+            job_id = g.jobs.submit(
+                generate_document, g.renderer, template, g.db.get_template(template), data, g.chunk_size, g.documents
+            )
+        except QueueFull:
+            flash('Слишком много документов в очереди, попробуйте позже')
+            return redirect(url_for('form_page.show', form_id=form_id))
 
-            if not data.get(var_name):
-                data[var_name] = {}
+        return redirect(url_for('job_page.status', job_id=job_id))
 
-            data[var_name][var_type] = value
-        else:
-            data[key] = value
+    with g.metrics.phase('image_processing'):
+        files = prepare_images(data, g.image_executor)
 
-    files = {}
+    key = None
 
-    i = 0
-    for value in data.values():
-        if type(value) is not dict:
-            continue
+    if g.documents:
+        key = g.documents.key(template, data, files)
 
-        if value.get('__type') == 'image':
-            img = Image.open(value['source'])
-            img_format = img.format.lower()
-            files[f'image{i}.{img_format}'] = (f'image{i}.{img_format}', img_to_bytes(img), f'image/{img_format}')
-            value['source'] = f'image{i}.{img_format}'
-            value['__height'] = img.height
-            value['__width'] = img.width
-            i += 1
+        if cached := g.documents.get(key):
+            return timed_send(send_file(cached, mimetype=DOCX_MIMETYPE, as_attachment=True, download_name='document.docx'))
 
-    doc_form = g.db.get_doc_form(form_label)
+    with g.metrics.phase('template_load'):
+        doc_form = g.db.get_template(template)
 
     try:
-        response = send_template(g.dfs_url, doc_form, data, files)
+        with g.metrics.phase('dfs'):
+            response = g.renderer.send_template(doc_form, data, files, stream=True, template_hash=template)
     except requests.exceptions.ConnectionError:
         flash('Не удалось подключиться к API')
         return redirect(url_for('form_page.show', form_id=form_id))
+    except requests.exceptions.Timeout:
+        flash('API не ответил вовремя')
+        return redirect(url_for('form_page.show', form_id=form_id))
+
+    return deliver(form_id, key, response)
+
 
+def deliver(form_id, key, response):
     if not response.ok:
+        response.close()
         flash('Что-то пошло не так')
         return redirect(url_for('form_page.show', form_id=form_id))
 
-    return send_file(BytesIO(response.content), as_attachment=True, download_name='document.docx')
+    if key:
+        try:
+            with g.metrics.phase('dfs_body'):
+                cached = g.documents.put(key, response.iter_content(g.chunk_size))
+        finally:
+            response.close()
+
+        return timed_send(send_file(cached, mimetype=DOCX_MIMETYPE, as_attachment=True, download_name='document.docx'))
+
+    return timed_send(stream_document(response, 'document.docx', g.chunk_size, g.spool_threshold))
+
+
+@form_page.route('/forms/<int:form_id>/batch', methods=['GET', 'POST'])
+def batch(form_id):
+    if not (cached := load_form(form_id)):
+        return abort(404)
+
+    form_label, template, form_class = cached
+    batch_form = BatchForm()
+
+    if request.method == 'GET':
+        if g.dfs_health.is_down:
+            flash('Не удалось подключиться к API')
+        return render_template('batch.html', batch_form=batch_form, form_label=form_label, form_id=form_id)
+
+    if g.dfs_health.is_down:
+        flash('Не удалось подключиться к API')
+        return redirect(url_for('form_page.batch', form_id=form_id))
+
+    if not batch_form.validate_on_submit():
+        flash_errors(batch_form)
+        return redirect(url_for('form_page.batch', form_id=form_id))
+
+    sample = form_class(formdata=None, meta={'csrf': False})
+
+    if any(field.name.endswith('-__type') and field.data == 'image' for field in sample):
+        flash('Пакетная генерация недоступна для форм с картинками')
+        return redirect(url_for('form_page.batch', form_id=form_id))
+
+    file = request.files['rows']
+    doc_form = g.db.get_template(template)
+    client, chunk_size, documents = g.renderer, g.chunk_size, g.documents
+
+    def rows():
+        for number, row in enumerate(read_rows(file.stream, file.filename), 1):
+            yield number, validate_row(form_class, row)
+
+    def render(data):
+        out = BytesIO()
+        generate_document(out, client, template, doc_form, data, chunk_size, documents)
+        return out.getvalue()
+
+    response = Response(stream_with_context(stream_zip(rows(), render, g.batch_workers)), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename='documents.zip')
+
+    return response
+
+
+job_page = Blueprint('job_page', 'job_page', template_folder='templates')
+@job_page.get('/jobs/<job_id>')
+def status(job_id):
+    if not g.jobs or not (job := g.jobs.get(job_id)):
+        return abort(404)
+
+    return render_template('job.html', job=job)
+
+
+@job_page.get('/jobs/<job_id>/download')
+def download(job_id):
+    if not g.jobs or not (job := g.jobs.get(job_id)) or job.status != 'done':
+        return abort(404)
+
+    return send_file(g.jobs.path(job_id), mimetype=DOCX_MIMETYPE, as_attachment=True, download_name='document.docx')
+
+
+def load_draft():
+    session.pop('custom_fields', None)
+    session.pop('choices', None)
+
+    if (draft_id := session.get('draft')) and (draft := g.db.load_draft(draft_id)) is not None:
+        return draft_id, draft
+
+    return secrets.token_urlsafe(16), {}
+
+
+def save_draft(draft_id, draft):
+    g.db.save_draft(draft_id, draft, g.draft_ttl)
+    session['draft'] = draft_id
+
+
+def resolve_choices(custom_fields):
+    labels = [field['label'] for field in custom_fields['select_fields'].values()]
+    choices = g.db.get_choices_by_labels(labels)
+
+    select_fields = {}
+
+    for field_name, field_data in custom_fields['select_fields'].items():
+        select_fields[field_name] = {
+            'choices': choices.get(field_data['label'], []),
+            'label': field_data['label']
+        }
+
+    return {
+        'static_fields': custom_fields['static_fields'],
+        'select_fields': select_fields
+    }
+
+
+metrics_page = Blueprint('metrics_page', 'metrics_page')
+@metrics_page.get('/metrics')
+def metrics():
+    return Response(g.metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 form_editor_page = Blueprint('form_editor_page', 'form_editor_page', template_folder='templates')
 @form_editor_page.route('/form-editor', methods=['GET', 'POST'])
 def form_editor():
-    if not (g.editor_access or session.get('authorized')):
+    if not is_editor():
         return abort(401)
 
-    if 'custom_fields' in session:
-        custom_fields = session['custom_fields']
-    else:
-        custom_fields = {'static_fields': {}, 'select_fields': {}}
+    draft_id, draft = load_draft()
+    custom_fields = draft.setdefault('custom_fields', {'static_fields': {}, 'select_fields': {}})
 
     editor = create_editor(get_editor_choices(g.predefined_fields, g.db.get_select_labels()))
     save = SaveFormForm()
-    preview = create_form(generate_fields(custom_fields, g.fields))
+    preview = create_form(generate_fields(resolve_choices(custom_fields), g.fields))
 
     if request.method == 'GET':
         return render_template('form_editor.html', preview=preview, editor=editor, save=save, editor_access=g.editor_access)
@@ -136,15 +326,15 @@ def form_editor():
 
         file = request.files['doc_form']
 
-        custom_fields['doc_form'] = file.read()
+        doc_form = file.read()
 
         file.close()
 
         try:
-            g.db.save_form(request.form['form_label'], custom_fields)
+            g.db.save_form(request.form['form_label'], dict(custom_fields, doc_form=doc_form))
 
-            custom_fields = {'static_fields': {}, 'select_fields': {}}
-            session['custom_fields'] = custom_fields
+            draft['custom_fields'] = {'static_fields': {}, 'select_fields': {}}
+            save_draft(draft_id, draft)
             save.form_label.data = ''
         except IntegrityError:
             flash(f'Форма {save.form_label.data} уже существует')
@@ -186,7 +376,6 @@ def form_editor():
                 del custom_fields['static_fields'][field_name]
 
             custom_fields['select_fields'][field_name] = {
-                'choices': g.db.get_choices(field_label),
                 'label': field_label
             }
 
@@ -203,7 +392,7 @@ def form_editor():
 
         editor.field_name.data = ''
 
-    session['custom_fields'] = custom_fields
+    save_draft(draft_id, draft)
 
     return redirect(url_for('form_editor_page.form_editor'))
 
@@ -211,13 +400,11 @@ def form_editor():
 field_editor_page = Blueprint('field_editor_page', 'field_editor_page', template_folder='templates')
 @field_editor_page.route('/field-editor', methods=['GET', 'POST'])
 def field_editor():
-    if not (g.editor_access or session.get('authorized')):
+    if not is_editor():
         return abort(401)
 
-    if 'choices' in session:
-        choices = session['choices']
-    else:
-        choices = []
+    draft_id, draft = load_draft()
+    choices = draft.setdefault('choices', [])
 
     preview = create_form({'select': SelectField('', choices=choices)})
     editor = SelectFieldEditor()
@@ -233,7 +420,7 @@ def field_editor():
 
         field_label = request.form['field_label']
 
-        editor_fields = session.get('custom_fields')
+        editor_fields = draft.get('custom_fields')
         if editor_fields:
             for field in editor_fields['select_fields'].values():
                 if field_label == field['label']:
@@ -261,8 +448,8 @@ def field_editor():
         try:
             g.db.save_select_field(request.form['field_label'], choices)
 
-            choices = []
-            session['choices'] = choices
+            draft['choices'] = []
+            save_draft(draft_id, draft)
             save.field_label.data = ''
         except IntegrityError:
             flash(f'Поле {save.field_label.data} уже существует')
@@ -293,7 +480,7 @@ def field_editor():
             del choices[choices.index(choice_name)]
             flash('Опция убрана')
 
-    session['choices'] = choices
+    save_draft(draft_id, draft)
 
     return redirect(url_for('field_editor_page.field_editor'))
 
@@ -337,16 +524,20 @@ def auth():
         return redirect(url_for('auth_page.auth'))
 
     if auth_form.authorize.data:
-        if g.editors.authenticate(username, password):
-            if g.editors.is_approved(username):
-                session['authorized'] = True
-                return redirect(url_for('index_page.index'))
+        approved = g.editors.authenticate(username, password)
+
+        if approved is None:
+            flash('Неверное имя или пароль')
+            return redirect(url_for('auth_page.auth'))
 
+        if not approved:
             flash('Ваш запрос пока что не был одобрен')
             return redirect(url_for('auth_page.auth'))
 
-        flash('Неверное имя или пароль')
-        return redirect(url_for('auth_page.auth'))
+        g.approvals.put(username, True)
+        session['authorized'] = True
+        session['editor'] = username
+        return redirect(url_for('index_page.index'))
 
     return redirect(url_for('auth_page.auth'))
 
@@ -354,4 +545,5 @@ def auth():
 @auth_page.route('/unauth')
 def unauth():
     session['authorized'] = False
+    session.pop('editor', None)
     return redirect(url_for('index_page.index'))
@@ -1,14 +1,31 @@
 import requests
 import json
+import logging
+import os
+import shutil
+import time
 
 from enum import IntEnum
 
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from threading import Event, Lock, Thread
 
-from flask import flash
+from flask import Response, flash, send_file
+from requests.adapters import HTTPAdapter
 from wtforms.fields.simple import HiddenField
 
 
+logger = logging.getLogger(__name__)
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+HASH_UNSUPPORTED = (400, 404, 415, 422)
+
+
+class DocumentError(Exception):
+    pass
+
+
 class Fields:
     def __init__(self, default_data, **kwargs):
         types = kwargs
@@ -81,6 +98,94 @@ def generate_fields(field_dict, field_classes):
     return fields
 
 
+def collect_data(form_data, form_files):
+    data = {}
+
+    it = list(form_data.items())
+    it.extend(list(form_files.items()))
+
+    for key, value in it:
+        if '-' in key:
+            var_name, var_type = tuple(key.split('-'))
+
+            if not data.get(var_name):
+                data[var_name] = {}
+
+            data[var_name][var_type] = value
+        else:
+            data[key] = value
+
+    return data
+
+
+def read_image(source):
+    from PIL import Image
+
+    raw = source.read()
+
+    with Image.open(BytesIO(raw)) as img:
+        return raw, img.format.lower(), img.width, img.height
+
+
+def prepare_images(data, executor=None):
+    files = {}
+
+    images = [value for value in data.values() if type(value) is dict and value.get('__type') == 'image']
+    sources = [value['source'] for value in images]
+
+    if executor and len(sources) > 1:
+        results = executor.map(read_image, sources)
+    else:
+        results = map(read_image, sources)
+
+    for i, (value, (raw, img_format, width, height)) in enumerate(zip(images, results)):
+        files[f'image{i}.{img_format}'] = (f'image{i}.{img_format}', raw, f'image/{img_format}')
+        value['source'] = f'image{i}.{img_format}'
+        value['__height'] = height
+        value['__width'] = width
+
+    return files
+
+
+def detach_images(data):
+    for value in data.values():
+        if type(value) is dict and value.get('__type') == 'image':
+            value['source'] = BytesIO(value['source'].read())
+
+
+def generate_document(out, client, template_hash, doc_form, data, chunk_size=65536, cache=None):
+    files = prepare_images(data)
+
+    if cache:
+        key = cache.key(template_hash, data, files)
+
+        if cached := cache.get(key):
+            with cached:
+                shutil.copyfileobj(cached, out)
+            return
+
+    try:
+        response = client.send_template(doc_form, data, files, stream=True, template_hash=template_hash)
+    except requests.exceptions.ConnectionError:
+        raise DocumentError('Не удалось подключиться к API')
+    except requests.exceptions.Timeout:
+        raise DocumentError('API не ответил вовремя')
+
+    try:
+        if not response.ok:
+            raise DocumentError('Что-то пошло не так')
+
+        if cache:
+            with cache.put(key, response.iter_content(chunk_size)) as cached:
+                shutil.copyfileobj(cached, out)
+            return
+
+        for chunk in response.iter_content(chunk_size):
+            out.write(chunk)
+    finally:
+        response.close()
+
+
 def img_to_bytes(img):
     b = BytesIO()
 
@@ -89,27 +194,202 @@ def img_to_bytes(img):
     return b.getvalue()
 
 
-def health_check(url):
-    url += '/api/health-check'
+class BufferedResponse:
+    def __init__(self, content=b'', status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {'Content-Type': DOCX_MIMETYPE}
+        self.headers['Content-Length'] = str(len(content))
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def iter_content(self, chunk_size=65536):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
 
-    try:
-        r = requests.get(url)
-    except requests.exceptions.ConnectionError:
-        return False
 
-    return r.ok
+class DFSClient:
+    def __init__(self, url, connect_timeout=3.0, read_timeout=60.0, pool_size=10, metrics=None, by_hash=False):
+        self._url = url
+        self._timeout = (connect_timeout, read_timeout)
+        self._metrics = metrics
+        self._by_hash = by_hash
+        self._hash_confirmed = False
+        self._bytes_saved = 0
+        self._pool_size = pool_size
+        self._session = self._new_session()
 
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def bytes_saved(self):
+        return self._bytes_saved
+
+    def _request(self, method, path, **kwargs):
+        start = time.perf_counter()
+
+        try:
+            r = self._session.request(method, self._url + path, timeout=self._timeout, **kwargs)
+        except requests.exceptions.Timeout:
+            if self._metrics:
+                self._metrics.dfs_timeouts.inc(path=path)
+            raise
+        except requests.exceptions.RequestException:
+            if self._metrics:
+                self._metrics.dfs_errors.inc(path=path, kind='connection')
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+
+            logger.info('DFS %s %s took %.3f s', method, path, elapsed)
+
+            if self._metrics:
+                self._metrics.dfs_requests.observe(elapsed, path=path)
+
+        if not r.ok and self._metrics:
+            self._metrics.dfs_errors.inc(path=path, kind='status')
+
+        return r
+
+    def health_check(self):
+        try:
+            r = self._request('GET', '/api/health-check')
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            return False
+
+        return r.ok
+
+    def send_template(self, doc_form, data, files, stream=False, template_hash=None):
+        payload = {
+            'data': json.dumps(data)
+        }
+
+        if template_hash:
+            payload['template_hash'] = template_hash
+
+        if template_hash and self._by_hash:
+            r = self._request('POST', '/api/generate-document', files=dict(files), data=payload, stream=stream)
+
+            if 'X-Template-Missing' in r.headers:
+                r.close()
+                self._hash_confirmed = True
+            elif r.ok:
+                self._hash_confirmed = True
+                self._bytes_saved += len(doc_form)
+
+                if self._metrics:
+                    self._metrics.template_bytes_saved.inc(len(doc_form))
+
+                return r
+            elif self._hash_confirmed:
+                return r
+            else:
+                r.close()
+
+                if r.status_code in HASH_UNSUPPORTED:
+                    self._by_hash = False
+                    logger.warning('DFS does not accept templates by hash, falling back to full uploads')
+
+        file_payload = dict(files)
+        file_payload['doc_form'] = ('template.docx', doc_form, DOCX_MIMETYPE)
+
+        return self._request('POST', '/api/generate-document', files=file_payload, data=payload, stream=stream)
+
+    def _new_session(self):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
 
-def send_template(url, doc_form, data, files):
-    url += '/api/generate-document'
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
 
-    payload = {
-        'data': json.dumps(data)
-    }
+        return session
 
-    file_payload = files
-    file_payload['doc_form'] = ('template.docx', doc_form, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+    def reset(self):
+        self._session = self._new_session()
 
-    r = requests.post(url, files=file_payload, data=payload)
+    def close(self):
+        self._session.close()
+
+
+def stream_document(response, download_name, chunk_size=65536, spool_threshold=1048576):
+    mimetype = response.headers.get('Content-Type', DOCX_MIMETYPE)
+    length = response.headers.get('Content-Length')
+
+    if length is None or 'Content-Encoding' in response.headers:
+        spool = SpooledTemporaryFile(max_size=spool_threshold)
+
+        try:
+            for chunk in response.iter_content(chunk_size):
+                spool.write(chunk)
+        finally:
+            response.close()
+
+        spool.seek(0)
+
+        return send_file(spool, mimetype=mimetype, as_attachment=True, download_name=download_name)
+
+    def generate():
+        try:
+            yield from response.iter_content(chunk_size)
+        finally:
+            response.close()
+
+    r = Response(generate(), mimetype=mimetype)
+    r.headers['Content-Length'] = length
+    r.headers.set('Content-Disposition', 'attachment', filename=download_name)
 
     return r
+
+
+class HealthProber:
+    def __init__(self, client, interval=10.0):
+        self._client = client
+        self._interval = interval
+        self._status = (None, None)
+        self._thread = None
+        self._pid = None
+        self._stop = Event()
+        self._lock = Lock()
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def is_down(self):
+        return self._status[0] is False
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            self._pid = os.getpid()
+            self._stop = Event()
+            self._thread = Thread(target=self._run, name='dfs-health-prober', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        ok = self._client.health_check()
+        self._status = (ok, time.time())
+
+        return ok
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception:
+                logger.exception('DFS health check failed')
+
+            self._stop.wait(self._interval)